@@ -6,23 +6,32 @@
 - planner: 规划模块
 - controller: 执行模块
 - memory: 记忆模块
+- plan_cache: 计划缓存
 - core: 核心 Agent 类
+
+设置 AGENT_FAST_PW=1 时，WebUIAgent.start() / pool() 启动浏览器前会给 Playwright 打性能补丁（见 _pw_patch），
+因此该变量写在 .env 里、由 load_dotenv() 加载也能生效。
 """
 
-from .models import ElementSnapshot, PlannerOutput, MemoryRecord
+from .models import ElementSnapshot, PlannerOutput, MemoryRecord, RunResult
 from .perception import Perception
-from .planner import Planner
+from .planner import Planner, create_client
 from .controller import Controller
 from .memory import Memory
-from .core import WebUIAgent
+from .plan_cache import PlanCache
+from .core import WebUIAgent, AgentPool
 
 __all__ = [
     "ElementSnapshot",
     "PlannerOutput",
     "MemoryRecord",
+    "RunResult",
     "Perception",
     "Planner",
+    "create_client",
     "Controller",
     "Memory",
+    "PlanCache",
     "WebUIAgent",
+    "AgentPool",
 ]
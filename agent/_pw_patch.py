@@ -0,0 +1,44 @@
+"""Playwright 性能补丁：去掉每次 API 调用时的 inspect.stack()
+
+playwright-python 在每次 API 调用时都会执行 inspect.stack() 以记录调用栈（用于 trace/报错定位），
+在高频调用的 Agent 循环中这部分开销可占到相当比例的 CPU。
+设置环境变量 AGENT_FAST_PW=1 启用补丁（WebUIAgent 启动浏览器时调用 apply()，可重复调用）；
+调试时不设置即可恢复完整调用栈。
+"""
+
+import inspect
+import os
+import sys
+import types
+
+
+class _NoStackInspect(types.ModuleType):
+    """替换 playwright 内部模块中的 inspect：stack() 直接返回空列表，其余属性透传"""
+    
+    def __getattr__(self, name):
+        return getattr(inspect, name)
+    
+    @staticmethod
+    def stack(context: int = 1):
+        return []
+
+
+def apply() -> bool:
+    """启用补丁，返回是否生效"""
+    if os.environ.get("AGENT_FAST_PW") != "1":
+        return False
+    # 上游若支持该开关则直接生效
+    os.environ.setdefault("PW_INSPECT_STACK", "0")
+    
+    try:
+        import playwright.async_api  # noqa: F401  确保 _impl 下的模块都已加载
+    except ImportError:
+        return False
+    
+    shim = _NoStackInspect("inspect")
+    patched = False
+    for name, module in list(sys.modules.items()):
+        if name.startswith("playwright._impl.") and getattr(module, "inspect", None) is inspect:
+            module.inspect = shim
+            patched = True
+    return patched
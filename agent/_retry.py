@@ -0,0 +1,8 @@
+"""重试退避：指数退避 + 随机抖动，避免并发任务在同一时刻集中重试"""
+
+import random
+
+
+def backoff_delay(attempt: int, base: float) -> float:
+    """第 attempt 次（从 0 开始）重试前的等待秒数：base * 2^attempt，外加最多 0.4 * base 的随机抖动"""
+    return base * (2 ** attempt) + random.random() * base * 0.4
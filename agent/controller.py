@@ -1,18 +1,119 @@
 """执行模块：执行 LLM 决策的动作"""
 
 import asyncio
-from typing import List
-from playwright.async_api import Page
+from typing import Dict, Optional, Tuple
+from playwright.async_api import ElementHandle, Page, TimeoutError as PlaywrightTimeoutError
+from ._retry import backoff_delay
 from .models import ElementSnapshot, PlannerOutput
+from .perception import Perception
+
+
+# 单次往返完成 检查 + 动作；点击被遮挡、取值被框架回滚时返回 fallback。
+# 与提取脚本一样通过 add_init_script 注册为 window.__agent_exec。
+CONTROLLER_JS = """
+(() => {
+    window.__agent_exec = (id, action, value) => {
+        // ID 表由提取脚本维护（window.__agent_ids）
+        const el = window.__agent_ids?.byId.get(id)?.deref();
+        if (!el || !el.isConnected) return 'notfound';
+
+        const style = window.getComputedStyle(el);
+        let rect = el.getBoundingClientRect();
+        if (style.display === 'none' || style.visibility === 'hidden' || parseFloat(style.opacity) === 0
+            || rect.width <= 0 || rect.height <= 0) return 'invisible';
+        if (el.disabled || el.getAttribute('aria-disabled') === 'true') return 'disabled';
+
+        if (rect.bottom < 0 || rect.top > window.innerHeight || rect.right < 0 || rect.left > window.innerWidth) {
+            el.scrollIntoView({ block: 'center', inline: 'center' });
+            rect = el.getBoundingClientRect();
+        }
+
+        // 预检：只做检查和滚动，动作稍后执行
+        if (action === 'prepare') return 'ok';
+
+        if (action === 'click') {
+            const hit = document.elementFromPoint(rect.left + rect.width / 2, rect.top + rect.height / 2);
+            if (hit && hit !== el && !el.contains(hit)) return 'fallback';
+            const opts = { bubbles: true, cancelable: true, view: window };
+            el.dispatchEvent(new PointerEvent('pointerdown', opts));
+            el.dispatchEvent(new MouseEvent('mousedown', opts));
+            el.dispatchEvent(new PointerEvent('pointerup', opts));
+            el.dispatchEvent(new MouseEvent('mouseup', opts));
+            el.click();
+            return 'ok';
+        }
+
+        if (action === 'fill') {
+            if (el.readOnly) return 'disabled';
+            el.focus();
+            // 通过原型上的 setter 赋值，React 等框架才能感知到变化
+            const proto = Object.getPrototypeOf(el);
+            const setter = Object.getOwnPropertyDescriptor(proto, 'value')?.set;
+            if (setter) setter.call(el, value); else el.value = value;
+            el.dispatchEvent(new Event('input', { bubbles: true }));
+            el.dispatchEvent(new Event('change', { bubbles: true }));
+            return el.value === value ? 'ok' : 'fallback';
+        }
+
+        return 'fallback';
+    };
+})();
+"""
+
+# 当前文档缺少 __agent_exec 时返回 'missing'，由调用方补注入
+_EXEC_CALL = "([id, action, value]) => window.__agent_exec ? window.__agent_exec(id, action, value) : 'missing'"
+
+# 按 ID 取元素句柄（已脱离文档的元素视为不存在），供 Playwright 原生动作回退使用
+_ELEMENT_CALL = "id => { const el = window.__agent_ids?.byId.get(id)?.deref(); return el && el.isConnected ? el : null; }"
+
+# 元素可能只是暂时不满足条件（动画/过渡中），退避后重试。
+# notfound 不在其中：ID 对应的是具体的 DOM 节点，节点脱离文档后不会再回来，重试只是白等
+_TRANSIENT_STATUSES = ("invisible",)
+
+# 按像素滚动：距离作为参数传入，脚本源码保持不变，不必每次拼接
+_SCROLL_BY = "dy => window.scrollBy(0, dy)"
 
 
 class Controller:
-    """执行模块：执行 LLM 决策的动作"""
+    """
+    执行模块：执行 LLM 决策的动作。
+    
+    动作完成后不做固定 sleep，而是等待页面事件（导航、加载状态、元素挂载），
+    最多等待 settle_timeout_ms，页面先就绪则立即返回。
+    """
     
-    def __init__(self, page: Page):
+    def __init__(self, page: Page, settle_timeout_ms: float = 1500, max_attempts: int = 3, retry_base: float = 0.25):
         self.page = page
+        self.settle_timeout_ms = settle_timeout_ms
+        # 暂时性失败最多尝试 max_attempts 次，第 n 次重试前等待 retry_base * 2^n 秒（带随机抖动）
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        # 流式规划期间提前发起的预检：(element_id, task)
+        self._prepared: Optional[Tuple[int, "asyncio.Task[str]"]] = None
     
-    async def execute(self, decision: PlannerOutput, snapshots: List[ElementSnapshot]) -> bool:
+    async def install(self):
+        """在页面上注册动作脚本：对之后加载的文档生效，并立即注入当前文档"""
+        await self.page.add_init_script(script=CONTROLLER_JS)
+        await self.page.evaluate(CONTROLLER_JS)
+    
+    def prepare(self, element_id: int):
+        """
+        在 LLM 仍在输出时提前对目标元素做可见性/启用检查并滚动到视口内，
+        execute 时若发现检查未通过可直接返回，省掉一次往返。
+        """
+        task = asyncio.create_task(self._exec_js(element_id, "prepare"))
+        self._prepared = (element_id, task)
+    
+    async def _take_prepared(self, element_id: int) -> Optional[str]:
+        """取出针对 element_id 的预检结果（没有则返回 None）"""
+        prepared, self._prepared = self._prepared, None
+        if prepared is None:
+            return None
+        prepared_id, task = prepared
+        status = await task
+        return status if prepared_id == element_id else None
+    
+    async def execute(self, decision: PlannerOutput, snapshots_by_id: Dict[int, ElementSnapshot]) -> bool:
         """
         执行决策，返回是否成功。
         """
@@ -24,10 +125,17 @@ class Controller:
             print("✓ 任务完成")
             return True
         
+        if action in ("click", "fill") and element_id is not None:
+            status = await self._take_prepared(element_id)
+            if status in ("notfound", "invisible", "disabled"):
+                return self._report(status, element_id)
+        else:
+            await self._take_prepared(-1)
+        
         if action == "click" and element_id is not None:
-            return await self._click(element_id, snapshots)
+            return await self._click(element_id, snapshots_by_id)
         elif action == "fill" and element_id is not None:
-            return await self._fill(element_id, value, snapshots)
+            return await self._fill(element_id, value, snapshots_by_id)
         elif action == "press":
             return await self._press(value)
         elif action == "scroll":
@@ -40,51 +148,173 @@ class Controller:
             print(f"❌ 未知 action: {action}")
             return False
     
-    async def _click(self, element_id: int, snapshots: List[ElementSnapshot]) -> bool:
-        """点击元素"""
+    async def execute_and_observe(
+        self,
+        decision: PlannerOutput,
+        snapshots_by_id: Dict[int, ElementSnapshot],
+        perception: Perception,
+        settle_ms: float,
+    ) -> Tuple[bool, Optional[tuple]]:
+        """
+        执行决策，并尽量把下一轮感知合并进同一次 page.evaluate。
+        
+        click/fill（链接、表单提交按钮除外，它们大概率跳转）在页面内执行动作、等 DOM 静默后直接提取元素，
+        返回 (是否成功, 提取结果)。其他动作、跳转、需要 Playwright 回退的情况返回提取结果 None，
+        由调用方常规感知。合并调用出错时动作可能已经生效，不再重复执行，直接按失败返回。
+        """
+        action, element_id = decision.action, decision.element_id
+        snap = snapshots_by_id.get(element_id) if element_id is not None else None
+        if action not in ("click", "fill") or snap is None or snap.tag == "a":
+            return await self.execute(decision, snapshots_by_id), None
+        
+        status = await self._take_prepared(element_id)
+        if status in ("notfound", "invisible", "disabled"):
+            return self._report(status, element_id), None
+        
+        value = (decision.value or "") if action == "fill" else None
         try:
-            snap = next((s for s in snapshots if s.id == element_id), None)
+            status, observation = await perception.act_and_extract(self.page, action, element_id, value, settle_ms)
+        except Exception as e:
+            if "Execution context was destroyed" not in str(e):
+                print(f"❌ 合并执行失败: {e}")
+                return False, None
+            # 动作触发了跳转，动作本身已生效
+            status, observation = "ok", None
+        
+        if status == "navigates":
+            # 提交按钮：动作尚未执行，走常规路径并等待导航
+            return await self._click(element_id, snapshots_by_id, navigates=True), None
+        if status == "fallback" or status in _TRANSIENT_STATUSES:
+            # 常规路径会对暂时性失败退避重试
+            return await self.execute(decision, snapshots_by_id), None
+        if status != "ok":
+            return self._report(status, element_id), None
+        
+        if action == "click":
+            print(f"✓ 点击 [{element_id}] {snap.label}")
+        else:
+            print(f"✓ 填充 [{element_id}] {snap.label} = '{decision.value}'")
+        return True, observation
+    
+    async def _exec_js(self, element_id: int, action: str, value: Optional[str] = None) -> str:
+        """
+        一次 page.evaluate 内完成可见性/启用检查和动作本身，返回状态：
+        ok | notfound | invisible | disabled | fallback（需要走 Playwright 原生动作）
+        """
+        try:
+            status = await self.page.evaluate(_EXEC_CALL, [element_id, action, value])
+            if status == "missing":
+                await self.page.evaluate(CONTROLLER_JS)
+                status = await self.page.evaluate(_EXEC_CALL, [element_id, action, value])
+            return status
+        except Exception as e:
+            # 点击触发跳转时，执行上下文可能在返回前就被销毁，此时动作其实已生效
+            if action == "click" and "Execution context was destroyed" in str(e):
+                return "ok"
+            print(f"⚠ JS 执行失败，改用 Playwright: {e}")
+            return "fallback"
+    
+    async def _exec_with_retry(self, element_id: int, action: str, value: Optional[str] = None) -> str:
+        """执行页面内动作；元素暂时不可见时按指数退避 + 抖动重试"""
+        for attempt in range(self.max_attempts):
+            status = await self._exec_js(element_id, action, value)
+            if status not in _TRANSIENT_STATUSES or attempt == self.max_attempts - 1:
+                return status
+            await asyncio.sleep(backoff_delay(attempt, self.retry_base))
+    
+    def _report(self, status: str, element_id: int) -> bool:
+        """打印检查失败原因"""
+        if status == "notfound":
+            print(f"❌ 找不到元素 ID {element_id}")
+        elif status == "invisible":
+            print(f"❌ 元素 {element_id} 不可见")
+        elif status == "disabled":
+            print(f"❌ 元素 {element_id} 被禁用")
+        else:
+            print(f"❌ 元素 {element_id} 状态未知: {status}")
+        return False
+    
+    async def _click(self, element_id: int, snapshots_by_id: Dict[int, ElementSnapshot], navigates: bool = False) -> bool:
+        """点击元素；链接或 navigates=True（如表单提交按钮）时等待导航"""
+        try:
+            snap = snapshots_by_id.get(element_id)
             if not snap:
                 print(f"❌ 找不到元素 ID {element_id}")
                 return False
             
-            locator = self.page.locator(f"[data-agent-id=\"{element_id}\"]")
-            
-            # 检查可见性和启用状态
-            if not await locator.is_visible():
-                print(f"❌ 元素 {element_id} 不可见")
-                return False
-            
-            if not await locator.is_enabled():
-                print(f"❌ 元素 {element_id} 被禁用")
-                return False
+            if snap.tag == "a" or navigates:
+                # 链接通常触发跳转：等待导航事件而不是固定时长
+                status = "notfound"
+                try:
+                    async with self.page.expect_navigation(wait_until="domcontentloaded", timeout=self.settle_timeout_ms):
+                        status = await self._click_once(element_id)
+                except PlaywrightTimeoutError:
+                    pass
+            else:
+                status = await self._click_once(element_id)
+            if status != "ok":
+                return self._report(status, element_id)
             
-            await locator.click()
             print(f"✓ 点击 [{element_id}] {snap.label}")
-            await asyncio.sleep(1.5)
             return True
         
         except Exception as e:
             print(f"❌ 点击失败: {e}")
             return False
     
-    async def _fill(self, element_id: int, value: str, snapshots: List[ElementSnapshot]) -> bool:
+    async def _click_once(self, element_id: int) -> str:
+        status = await self._exec_with_retry(element_id, "click")
+        if status == "fallback":
+            # 被遮挡等情况交给 Playwright（自带可操作性检查）处理
+            element = await self._element(element_id)
+            if element is None:
+                return "notfound"
+            try:
+                await element.click()
+            finally:
+                await self._dispose(element)
+            status = "ok"
+        return status
+    
+    async def _element(self, element_id: int) -> Optional[ElementHandle]:
+        """Playwright 元素句柄：只在页面内脚本处理不了时使用（自带等待与可操作性检查，但需要多次往返）"""
+        handle = await self.page.evaluate_handle(_ELEMENT_CALL, element_id)
+        element = handle.as_element()
+        if element is None:
+            await handle.dispose()
+        return element
+    
+    @staticmethod
+    async def _dispose(element: ElementHandle):
+        """释放元素句柄；点击触发导航后旧文档的句柄已失效，释放失败可忽略"""
+        try:
+            await element.dispose()
+        except Exception:
+            pass
+    
+    async def _fill(self, element_id: int, value: str, snapshots_by_id: Dict[int, ElementSnapshot]) -> bool:
         """填充输入框"""
         try:
-            snap = next((s for s in snapshots if s.id == element_id), None)
+            snap = snapshots_by_id.get(element_id)
             if not snap:
                 print(f"❌ 找不到元素 ID {element_id}")
                 return False
             
-            locator = self.page.locator(f"[data-agent-id=\"{element_id}\"]")
-            
-            if not await locator.is_visible():
-                print(f"❌ 元素 {element_id} 不可见")
-                return False
+            # 输入框可能正处于过渡动画中：不可见时退避重试
+            status = await self._exec_with_retry(element_id, "fill", value or "")
+            if status == "fallback":
+                # 受控组件回滚了取值等情况，改用 Playwright 模拟真实输入
+                element = await self._element(element_id)
+                if element is None:
+                    return self._report("notfound", element_id)
+                try:
+                    await element.fill(value or "")
+                finally:
+                    await self._dispose(element)
+            elif status != "ok":
+                return self._report(status, element_id)
             
-            await locator.fill(value or "")
             print(f"✓ 填充 [{element_id}] {snap.label} = '{value}'")
-            await asyncio.sleep(1)
             return True
         
         except Exception as e:
@@ -94,9 +324,14 @@ class Controller:
     async def _press(self, key: str) -> bool:
         """按键"""
         try:
-            await self.page.keyboard.press(key)
+            # Enter 等按键可能提交表单：等待导航事件（最多 settle_timeout_ms），
+            # 不能只等 load state——旧文档已加载完毕，会在新页面提交前立即返回
+            try:
+                async with self.page.expect_navigation(wait_until="domcontentloaded", timeout=self.settle_timeout_ms):
+                    await self.page.keyboard.press(key)
+            except PlaywrightTimeoutError:
+                pass
             print(f"✓ 按键 {key}")
-            await asyncio.sleep(1)
             return True
         except Exception as e:
             print(f"❌ 按键失败: {e}")
@@ -110,9 +345,8 @@ class Controller:
             elif direction == "up":
                 await self.page.keyboard.press("PageUp")
             else:
-                await self.page.evaluate(f"window.scrollBy(0, {direction})")
+                await self.page.evaluate(_SCROLL_BY, float(direction))
             print(f"✓ 滚动 {direction}")
-            await asyncio.sleep(1)
             return True
         except Exception as e:
             print(f"❌ 滚动失败: {e}")
@@ -132,9 +366,8 @@ class Controller:
     async def _back(self) -> bool:
         """返回"""
         try:
-            await self.page.go_back()
+            await self.page.go_back(wait_until="domcontentloaded", timeout=self.settle_timeout_ms * 4)
             print(f"✓ 返回")
-            await asyncio.sleep(2)
             return True
         except Exception as e:
             print(f"❌ 返回失败: {e}")
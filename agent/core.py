@@ -1,81 +1,393 @@
 """Web UI 自动化智能体核心类"""
 
 import asyncio
-from typing import Optional
+from contextlib import asynccontextmanager
+from dataclasses import replace
+from typing import Dict, List, Optional, Tuple
 from openai import AsyncOpenAI
-from playwright.async_api import async_playwright, Page
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page, Playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 
+from . import _pw_patch
 from .perception import Perception
 from .planner import Planner
 from .controller import Controller
 from .memory import Memory
-from .models import ElementSnapshot
+from .models import ElementSnapshot, PlannerOutput, RunResult
+from .plan_cache import PlanCache, PlanStep
+
+
+# 无头模式（批量评测 / CI）下的 Chromium 启动参数
+_HEADLESS_ARGS = ["--disable-dev-shm-usage", "--no-sandbox"]
 
 
 class WebUIAgent:
-    """Web UI 自动化智能体"""
+    """
+    Web UI 自动化智能体。
+    
+    生命周期：start() 启动浏览器 → run()/step() 执行任务 → stop() 关闭浏览器，
+    也可以用 async with WebUIAgent(...) as agent 包住多次 run()，浏览器只启动一次。
+    直接调用 run() 时会自动 start/stop；批量执行可用 WebUIAgent.pool() 预热多个 context 复用。
+    """
     
-    def __init__(self, client: AsyncOpenAI, model: str):
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        model: str,
+        adapt_model: Optional[str] = None,
+        headless: bool = False,
+        plan_cache: Optional[PlanCache] = None,
+        rescan_delay: float = 0.8,
+        structured_output: bool = False,
+    ):
         self.client = client
         self.model = model
+        self.headless = headless
+        # 等待 LLM 期间，延迟 rescan_delay 秒后推测性地重新扫描一次 DOM
+        self.rescan_delay = rescan_delay
         self.perception = Perception()
-        self.planner = Planner(client, model)
+        self.plan_cache = plan_cache if plan_cache is not None else PlanCache()
+        # structured_output：服务端支持 response_format=json_schema 时开启，省去系统提示词中的 schema
+        self.planner = Planner(
+            client, model, plan_cache=self.plan_cache, adapt_model=adapt_model, structured_output=structured_output
+        )
         self.memory = Memory()
         self.controller: Optional[Controller] = None
         self.page: Optional[Page] = None
+        self.browser: Optional[Browser] = None
+        self.context: Optional[BrowserContext] = None
+        self._playwright: Optional[Playwright] = None
+        
+        # 当前任务的状态
+        self._observation = None
+        self._cache_key = None
+        self._decisions: List[PlanStep] = []
+        self._clean = True
+    
+    async def start(self):
+        """启动 playwright、浏览器、context 与页面"""
+        if self.page is not None:
+            return
+        _pw_patch.apply()
+        self._playwright = await async_playwright().start()
+        if self.headless:
+            browser = await self._playwright.chromium.launch(headless=True, args=_HEADLESS_ARGS)
+        else:
+            browser = await self._playwright.chromium.launch(headless=False)
+        await self._attach(browser, await browser.new_context())
+    
+    async def stop(self):
+        """关闭由 start() 启动的浏览器（池中的 Agent 由池统一关闭）"""
+        if self._playwright is None:
+            return
+        await self.browser.close()
+        await self._playwright.stop()
+        self._playwright = None
+        self.browser = self.context = self.page = self.controller = None
     
-    async def run(self, instruction: str, start_url: str, max_steps: int = 20):
+    async def __aenter__(self) -> "WebUIAgent":
+        await self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+    
+    async def _attach(self, browser: Browser, context: BrowserContext):
+        """绑定到已有的浏览器 context，并打开工作页面"""
+        self.browser = browser
+        self.context = context
+        self.page = await context.new_page()
+        self.controller = Controller(self.page)
+        # 提取/动作脚本只注册一次，后续每步按名字调用
+        await self.perception.install(self.page)
+        await self.controller.install()
+    
+    async def recycle(self):
+        """清理会话状态以便复用：清 cookie、关闭弹出页、回到空白页，不重启浏览器"""
+        await self.context.clear_cookies()
+        for page in self.context.pages:
+            if page is not self.page:
+                await page.close()
+        await self.page.goto("about:blank")
+    
+    @classmethod
+    async def pool(cls, client: AsyncOpenAI, model: str, size: int = 4, **kwargs) -> "AgentPool":
         """
-        执行任务的主循环。
+        预热 size 个无头 Agent：共享一个浏览器进程和计划缓存，每个 Agent 独占一个 context。
+        其余参数透传给构造函数（池中的浏览器总是无头的，传入的 headless 会被忽略）。
         """
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=False)
-            self.page = await browser.new_page()
-            self.controller = Controller(self.page)
-            
-            await self.page.goto(start_url)
-            self.memory.record_url(start_url)
-            await asyncio.sleep(2)
-            
+        _pw_patch.apply()
+        playwright = await async_playwright().start()
+        browser = await playwright.chromium.launch(headless=True, args=_HEADLESS_ARGS)
+        plan_cache = kwargs.pop("plan_cache", None)
+        if plan_cache is None:
+            plan_cache = PlanCache()
+        kwargs.pop("headless", None)
+        agents = []
+        for _ in range(size):
+            agent = cls(client, model, headless=True, plan_cache=plan_cache, **kwargs)
+            await agent._attach(browser, await browser.new_context())
+            agents.append(agent)
+        return AgentPool(playwright, browser, agents)
+    
+    async def run(
+        self, instruction: str, start_url: str, max_steps: int = 20, post_action_delay: float = 1.5
+    ) -> RunResult:
+        """
+        执行任务的主循环，返回执行结果（是否到达 done、步数与历史）。
+        
+        动作后的稳定等待在循环层统一进行：等待页面加载事件，最多 post_action_delay 秒，
+        页面先就绪则立即提取，不做固定 sleep；click/fill 则在页面内执行后等 DOM 静默
+        （最多 post_action_delay）直接提取，动作与感知只需一次往返。
+        
+        任务顺利完成（无失败步骤、未触发回退）时，决策序列会以起始页为键写入计划缓存，
+        以后遇到相同指令 + 相同起始页时直接重放。
+        """
+        owns_browser = self.page is None
+        if owns_browser:
+            await self.start()
+        
+        done = False
+        try:
+            await self.begin(instruction, start_url, post_action_delay)
             for step in range(max_steps):
                 print(f"\n{'='*60}")
                 print(f"Step {step + 1}/{max_steps}")
                 print(f"{'='*60}")
                 
-                # 1. 感知
-                snapshots, dom_summary = await self.perception.extract_elements(self.page)
-                print(f"✓ 提取 {len(snapshots)} 个可交互元素")
-                
-                # 2. 规划
-                decision = await self.planner.decide(instruction, dom_summary, self.memory)
-                print(f"思考: {decision.thought}")
-                print(f"计划: {' → '.join(decision.plan)}")
-                print(f"动作: {decision.action} (element_id={decision.element_id})")
-                
-                # 3. 执行
-                success = await self.controller.execute(decision, snapshots)
-                self.memory.record(
-                    action=decision.action,
-                    element_id=decision.element_id,
-                    element_label=next((s.label for s in snapshots if s.id == decision.element_id), None),
-                    result="success" if success else "failed"
-                )
-                
-                # 4. 判断是否完成
-                if decision.action == "done":
-                    print(f"\n✓✓✓ 任务完成 ✓✓✓")
+                if await self.step(instruction, post_action_delay):
+                    done = True
                     break
-                
-                # 5. 检查死循环
-                if self.memory.is_repeated_action(decision.action, decision.element_id, threshold=3):
-                    print(f"⚠ 检测到重复操作，尝试回退...")
-                    await self.controller._back()
-                
-                # 记录当前 URL
-                current_url = self.page.url
-                self.memory.record_url(current_url)
-                
-                await asyncio.sleep(1)
-            
-            await browser.close()
+        finally:
+            if owns_browser:
+                await self.stop()
+        if done:
             print(f"\n✓ Agent 执行完成（共 {self.memory.step_counter} 步）")
+        else:
+            print(f"\n⚠ 达到最大步数 {max_steps}，任务未完成")
+        return RunResult(instruction, done, self.memory.step_counter, self.memory.history)
+    
+    async def run_parallel(
+        self,
+        subtasks: List[Tuple[str, str]],
+        max_steps: int = 20,
+        post_action_delay: float = 1.5,
+        max_concurrency: int = 8,
+        isolated: bool = False,
+    ) -> list:
+        """
+        并发执行互相独立的子任务 [(instruction, start_url), ...]。
+        
+        每个子任务一个标签页，各自拥有 Perception / Memory / Controller，
+        Planner（及其 AsyncOpenAI client 的连接池）共享，LLM 请求在 HTTP 层并发。
+        同时运行的子任务最多 max_concurrency 个（兼顾 LLM 服务的限流），其余排队，标签页按需打开。
+        isolated=True 时每个子任务使用独立的 context（cookie / 存储互不影响），否则共享当前 context。
+        返回各子任务的 RunResult（按 subtasks 顺序）；出错的子任务会打印错误，对应位置为异常对象。
+        """
+        owns_browser = self.page is None
+        if owns_browser:
+            await self.start()
+        
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def run_one(instruction: str, start_url: str):
+            async with semaphore:
+                worker = await self._fork(isolated)
+                try:
+                    return await worker.run(instruction, start_url, max_steps, post_action_delay)
+                finally:
+                    if isolated:
+                        await worker.context.close()
+                    else:
+                        await worker.page.close()
+        
+        try:
+            results = await asyncio.gather(
+                *(run_one(instr, url) for instr, url in subtasks),
+                return_exceptions=True,
+            )
+        finally:
+            if owns_browser:
+                await self.stop()
+        for (instruction, _), result in zip(subtasks, results):
+            if isinstance(result, BaseException):
+                print(f"❌ 子任务失败（{instruction}）: {type(result).__name__}: {result}")
+        return results
+    
+    async def _fork(self, isolated: bool = False) -> "WebUIAgent":
+        """新开一个标签页（isolated 时在新 context 中），返回共享 Planner 的子 Agent"""
+        worker = WebUIAgent(
+            self.client, self.model, headless=self.headless, plan_cache=self.plan_cache, rescan_delay=self.rescan_delay
+        )
+        context = await self.browser.new_context() if isolated else self.context
+        worker.planner = self.planner
+        await worker._attach(self.browser, context)
+        return worker
+    
+    async def begin(self, instruction: str, start_url: str, settle_delay: float = 1.5):
+        """开始新任务：重置任务状态，打开起始页并完成第一次感知"""
+        self.perception.reset()
+        self.memory = Memory()
+        self._cache_key = None
+        self._decisions = []
+        self._clean = True
+        
+        await self.page.goto(start_url, wait_until="domcontentloaded")
+        self.memory.record_url(start_url)
+        # 起始页的异步内容：等网络空闲，但最多 settle_delay 秒（长连接页面永远不会空闲）
+        await self._settle("networkidle", settle_delay)
+        self._observation = await self.perception.extract_elements(self.page)
+    
+    async def step(self, instruction: str, post_action_delay: float = 1.5) -> bool:
+        """执行一步 感知 → 规划 → 执行 → 记忆，返回任务是否已完成"""
+        # 1. 感知（上一步末尾已在页面就绪后完成）
+        snapshots, dom_summary, snapshots_by_id = self._observation
+        print(f"✓ 提取 {len(snapshots)} 个可交互元素")
+        if not self.perception.summary_is_diff:
+            # 完整列表自成上下文，之前的对话轮次不再需要
+            self.memory.dialogue.clear()
+        if self._cache_key is None:
+            self._cache_key = self.plan_cache.key(instruction, dom_summary)
+        
+        # 2. 规划（等待 LLM 的同时推测性地重新扫描 DOM，决策到达时执行端已有最新的页面状态）
+        rescan = asyncio.create_task(self._rescan())
+        try:
+            decision = await self.planner.decide(
+                instruction, dom_summary, self.memory,
+                on_action=self._on_action, page_state=self.perception.fingerprint,
+                snapshots_by_id=snapshots_by_id,
+            )
+        finally:
+            # 决策先于扫描到达（如命中缓存）时不再等待扫描
+            scanned = rescan.done()
+            if not scanned:
+                rescan.cancel()
+        if scanned:
+            decision, snapshots_by_id = self._revalidate(decision, snapshots_by_id, rescan)
+        print(f"思考: {decision.thought}")
+        print(f"计划: {' → '.join(decision.plan)}")
+        print(f"动作: {decision.action} (element_id={decision.element_id})")
+        
+        # 3. 执行（click/fill 与下一轮感知合并为一次往返）；
+        # 链接跳转、按键、后退等待导航的上限同样取 post_action_delay
+        self.controller.settle_timeout_ms = post_action_delay * 1000
+        success, observation = await self.controller.execute_and_observe(
+            decision, snapshots_by_id, self.perception, post_action_delay * 1000
+        )
+        snap = snapshots_by_id.get(decision.element_id)
+        self.memory.record(
+            action=decision.action,
+            element_id=decision.element_id,
+            element_label=snap.label if snap else None,
+            result="success" if success else "failed"
+        )
+        # 连同目标元素的 (标签, 文本) 一起记录，重放时据此核对 ID 是否仍指向同一元素
+        self._decisions.append((decision, (snap.tag, snap.label) if snap and decision.element_id is not None else None))
+        if not success:
+            self._clean = False
+            # 重放的动作失败说明页面已不同，放弃剩余缓存计划，回到 LLM 规划
+            self.memory.pending_plan.clear()
+        
+        # 4. 判断是否完成
+        if decision.action == "done":
+            print(f"\n✓✓✓ 任务完成 ✓✓✓")
+            if self._clean:
+                self.plan_cache.put(self._cache_key, instruction, self._decisions)
+            return True
+        
+        # 5. 检查死循环
+        if self.memory.is_repeated_action(decision.action, decision.element_id, threshold=3):
+            print(f"⚠ 检测到重复操作，尝试回退...")
+            self._clean = False
+            self.memory.pending_plan.clear()
+            await self.controller._back()
+            # 合并提取的结果已过期且未交给 LLM，不能作为增量基线
+            observation = None
+            self.perception.invalidate()
+        
+        # 记录当前 URL
+        current_url = self.page.url
+        self.memory.record_url(current_url)
+        
+        self._observation = observation or await self._observe(post_action_delay)
+        return False
+    
+    async def _rescan(self) -> Dict[int, ElementSnapshot]:
+        await asyncio.sleep(self.rescan_delay)
+        return await self.perception.rescan(self.page)
+    
+    def _revalidate(
+        self,
+        decision: PlannerOutput,
+        snapshots_by_id: Dict[int, ElementSnapshot],
+        rescan: "asyncio.Task[Dict[int, ElementSnapshot]]",
+    ) -> Tuple[PlannerOutput, Dict[int, ElementSnapshot]]:
+        """
+        用推测扫描的结果校验决策：ID 按 DOM 节点分配，目标 ID 仍在页面上就仍是同一元素，直接改用最新快照；
+        ID 已失效时，仅当最新快照中恰好有一个 (标签, 文本) 相同的元素才重新定位，
+        有多个同名元素（如多个“查看详情”）时无法判断，保持原决策。扫描失败时保持原样。
+        """
+        if rescan.exception() is not None:
+            return decision, snapshots_by_id
+        fresh = rescan.result()
+        old = snapshots_by_id.get(decision.element_id) if decision.element_id is not None else None
+        if old is None or old.id in fresh:
+            return decision, fresh
+        matches = [s for s in fresh.values() if (s.tag, s.label) == (old.tag, old.label)]
+        if len(matches) != 1:
+            return decision, snapshots_by_id
+        match = matches[0]
+        print(f"⚠ 元素 {old.id} 已消失，按文本重新定位为 [{match.id}] {match.label}")
+        return replace(decision, element_id=match.id), fresh
+    
+    def _on_action(self, fields: dict):
+        """流式规划中动作字段就绪：提前预检目标元素"""
+        element_id = fields.get("element_id")
+        if fields.get("action") in ("click", "fill") and isinstance(element_id, int):
+            self.controller.prepare(element_id)
+    
+    async def _observe(self, settle_delay: float):
+        """等待页面 DOM 就绪（最多 settle_delay 秒）后提取下一轮元素"""
+        await self._settle("domcontentloaded", settle_delay)
+        return await self.perception.extract_elements(self.page)
+    
+    async def _settle(self, state: str, timeout: float):
+        """等待页面到达加载状态 state，超时即放弃；页面已就绪时立即返回"""
+        try:
+            await self.page.wait_for_load_state(state, timeout=timeout * 1000)
+        except PlaywrightTimeoutError:
+            pass
+
+
+class AgentPool:
+    """预热的 Agent 池：借出空闲 Agent 执行任务，归还时清理会话而不是重启浏览器"""
+    
+    def __init__(self, playwright: Playwright, browser: Browser, agents: List[WebUIAgent]):
+        self._playwright = playwright
+        self._browser = browser
+        self.agents = agents
+        self._idle: asyncio.Queue = asyncio.Queue()
+        for agent in agents:
+            self._idle.put_nowait(agent)
+    
+    @asynccontextmanager
+    async def acquire(self):
+        """借出一个空闲 Agent，用完自动回收"""
+        agent = await self._idle.get()
+        try:
+            yield agent
+        finally:
+            try:
+                await agent.recycle()
+            finally:
+                # 清理失败也要归还，否则池会逐渐耗尽、后续调用永远等待
+                self._idle.put_nowait(agent)
+    
+    async def run(self, instruction: str, start_url: str, **kwargs) -> RunResult:
+        """在任一空闲 Agent 上执行任务；并发调用数超过池大小时排队等待"""
+        async with self.acquire() as agent:
+            return await agent.run(instruction, start_url, **kwargs)
+    
+    async def close(self):
+        await self._browser.close()
+        await self._playwright.stop()
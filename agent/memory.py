@@ -1,52 +1,66 @@
 """记忆模块：保存历史步骤和访问记录"""
 
-from typing import List, Optional
-from .models import MemoryRecord
+import sys
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional
+from .models import ACTION_CODES, MemoryRecord, PlannerOutput
+from .plan_cache import PlanStep
 
 
 class Memory:
     """记忆模块：保存历史步骤和访问记录"""
     
-    def __init__(self):
+    def __init__(self, history_window: int = 5):
         self.history: List[MemoryRecord] = []
-        self.visited_urls: List[str] = []
-        self.failed_elements: List[int] = []
+        # URL → 首次访问时的步数（dict 保持插入顺序，成员判断 O(1)）
+        self._visited: Dict[str, int] = {}
+        # 元素 ID → 失败次数
+        self.failed_elements: Counter = Counter()
         self.step_counter = 0
+        # 最近 history_window 步的格式化文本，每步只格式化一次
+        self._formatted_lines: Deque[str] = deque(maxlen=history_window)
+        # 命中计划缓存后待重放的决策（附带目标元素的 (标签, 文本)）
+        self.pending_plan: Deque[PlanStep] = deque()
+        # 自最近一次完整 DOM 列表以来与 Planner 的对话轮次（增量摘要需要上下文）
+        self.dialogue: List[Dict[str, str]] = []
+        # 页面状态键 → 该状态下的 LLM 决策；页面没有变化时直接复用，不重复请求
+        self.decision_cache: Dict[str, PlannerOutput] = {}
+        # 连续命中决策缓存的次数，超过上限后强制重新询问 LLM，避免原地打转
+        self.decision_hits = 0
     
     def record(self, action: str, element_id: Optional[int], element_label: Optional[str], result: str):
         """记录单步操作"""
         self.step_counter += 1
         record = MemoryRecord(
             step_num=self.step_counter,
-            action=action,
+            action=ACTION_CODES.get(action, -1),
             element_id=element_id,
-            element_label=element_label,
-            result=result
+            element_label=sys.intern(element_label) if element_label else element_label,
+            result=result == "success"
         )
         self.history.append(record)
+        label_str = f" ({element_label})" if element_label else ""
+        self._formatted_lines.append(f"Step {record.step_num}: {action}{label_str} → {result}")
         
         if result == "failed" and element_id is not None:
-            self.failed_elements.append(element_id)
+            self.failed_elements[element_id] += 1
+    
+    @property
+    def visited_urls(self) -> List[str]:
+        """按首次访问顺序排列的 URL 列表"""
+        return list(self._visited)
     
     def record_url(self, url: str):
         """记录访问过的 URL"""
-        if url not in self.visited_urls:
-            self.visited_urls.append(url)
+        self._visited.setdefault(url, self.step_counter)
     
     def is_repeated_action(self, action: str, element_id: Optional[int], threshold: int = 2) -> bool:
         """判断最近是否重复执行了相同动作"""
+        code = ACTION_CODES.get(action, -1)
         recent = self.history[-threshold:]
-        count = sum(1 for r in recent if r.action == action and r.element_id == element_id)
+        count = sum(1 for r in recent if r.action == code and r.element_id == element_id)
         return count >= threshold
     
-    def format_history(self, last_n: int = 5) -> str:
-        """格式化内存中的历史记录"""
-        if not self.history:
-            return "(无历史)"
-        
-        lines = []
-        for rec in self.history[-last_n:]:
-            label_str = f" ({rec.element_label})" if rec.element_label else ""
-            lines.append(f"Step {rec.step_num}: {rec.action}{label_str} → {rec.result}")
-        
-        return "\n".join(lines)
+    def format_history(self) -> str:
+        """格式化内存中的历史记录（最近 history_window 步）"""
+        return "\n".join(self._formatted_lines) or "(无历史)"
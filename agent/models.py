@@ -1,12 +1,19 @@
 """数据模型定义"""
 
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from typing import List, Optional, Tuple
+
+
+# 动作词表：MemoryRecord 中以下标存储，未知动作记为 -1
+ACTIONS = ("click", "fill", "press", "scroll", "wait", "back", "done")
+ACTION_CODES = {name: code for code, name in enumerate(ACTIONS)}
 
 
 @dataclass
 class ElementSnapshot:
     """单个可交互元素的快照"""
+    __slots__ = ("id", "tag", "role", "label", "name", "input_type", "disabled", "bbox", "context")
+    
     id: int
     tag: str
     role: Optional[str]
@@ -14,13 +21,15 @@ class ElementSnapshot:
     name: Optional[str]
     input_type: Optional[str]
     disabled: bool
-    bbox: Optional[Dict]  # {x, y, width, height}
+    bbox: Optional[Tuple[float, float, float, float]]  # (x, y, width, height)
     context: Optional[str]  # 上下文（如最近的 form legend 或父级文本）
 
 
 @dataclass
 class PlannerOutput:
     """Planner 输出的结构化决策"""
+    __slots__ = ("thought", "plan", "action", "element_id", "value")
+    
     thought: str
     plan: List[str]  # 多步计划
     action: str  # click|fill|press|scroll|wait|back|done
@@ -30,9 +39,26 @@ class PlannerOutput:
 
 @dataclass
 class MemoryRecord:
-    """单条历史记录"""
+    """单条历史记录（紧凑存储，适合长会话）"""
+    __slots__ = ("step_num", "action", "element_id", "element_label", "result")
+    
     step_num: int
-    action: str
+    action: int  # ACTIONS 下标，-1 表示未知动作
     element_id: Optional[int]
-    element_label: Optional[str]
-    result: str  # success|failed
+    element_label: Optional[str]  # 已 sys.intern
+    result: bool  # True=success, False=failed
+    
+    @property
+    def action_name(self) -> str:
+        return ACTIONS[self.action] if self.action >= 0 else "unknown"
+
+
+@dataclass
+class RunResult:
+    """一次任务执行的结果"""
+    __slots__ = ("instruction", "done", "steps", "history")
+    
+    instruction: str
+    done: bool  # 是否以 action=done 结束（False 表示用完了 max_steps）
+    steps: int
+    history: List[MemoryRecord]
@@ -1,22 +1,275 @@
 """感知模块：提取页面中的可交互元素"""
 
-from typing import List, Tuple
+import hashlib
+from typing import Dict, List, Optional, Set, Tuple
 from playwright.async_api import Page
 from .models import ElementSnapshot
 
 
+# 提取脚本：通过 add_init_script 在每个文档加载时注册为 window.__agent_extract，
+# 之后每步只需发送一行调用表达式，不再重复传输和编译整段源码。
+# 传入 pending 时先调用 window.__agent_exec 执行动作，等 DOM 静默后再提取，
+# 把“执行上一步动作 + 感知下一步”合并成一次往返。
+PERCEPTION_JS = """
+(() => {
+    // 元素 ↔ ID 的对应关系保存在页面内（WeakMap + WeakRef），不写 DOM 属性；
+    // 重复注入时沿用已有的表，执行脚本（__agent_exec）也通过它按 ID 找元素
+    const registry = window.__agent_ids = window.__agent_ids || { byEl: new WeakMap(), byId: new Map(), next: 0 };
+
+    const scan = (startId) => {
+        // checkVisibility（Chromium 105+）在引擎内部一次完成 display/visibility/opacity 判断，
+        // 不必为每个节点解析完整的计算样式；不支持时退回 getComputedStyle
+        const hasCheckVisibility = typeof Element.prototype.checkVisibility === 'function';
+        const isVisible = (el) => {
+            if (hasCheckVisibility) {
+                return el.checkVisibility({ checkOpacity: true, checkVisibilityCSS: true });
+            }
+            const style = window.getComputedStyle(el);
+            if (style.display === 'none') return false;
+            if (style.visibility === 'hidden') return false;
+            if (parseFloat(style.opacity) === 0) return false;
+            return true;
+        };
+
+        const isInteractive = (el) => {
+            if (el.tagName === 'INPUT') {
+                const type = (el.getAttribute('type') || '').toLowerCase();
+                if (type === 'hidden') return false;
+            }
+            if (el.tagName === 'A') {
+                const href = el.getAttribute('href');
+                const role = el.getAttribute('role');
+                return href || role === 'button';
+            }
+            return true;
+        };
+
+        // 聚合 label 的逻辑
+        const getLabel = (el) => {
+            const candidates = [
+                (el.innerText || '').trim(),
+                (el.value || '').trim(),
+                el.getAttribute('placeholder') || '',
+                el.getAttribute('aria-label') || '',
+                el.getAttribute('title') || '',
+                el.getAttribute('alt') || '',
+                el.getAttribute('name') || '',
+            ];
+            const chosen = candidates.find(c => c.length > 0);
+            return chosen || '(无文本)';
+        };
+
+        // 获取上下文（最近的 form/fieldset 以及父元素文本）
+        const getContext = (el) => {
+            let form = el.closest('form');
+            let fieldset = el.closest('fieldset');
+            let legend = fieldset?.querySelector('legend');
+            let parentText = (el.parentElement?.innerText || '').trim().split('\\n')[0];
+
+            let parts = [];
+            if (legend) parts.push('legend=' + legend.innerText.trim());
+            if (form?.id) parts.push('form=' + form.id);
+            if (parentText && parentText !== getLabel(el)) parts.push('parent=' + parentText.slice(0, 30));
+
+            // 用 ';' 分隔，'|' 留给摘要行的字段分隔
+            return parts.length > 0 ? parts.join(';') : null;
+        };
+
+        // 1. 用一个 TreeWalker 收集候选元素（代替 querySelectorAll）
+        const INTERACTIVE_TAGS = new Set(['BUTTON', 'A', 'INPUT', 'TEXTAREA', 'SELECT']);
+        const root = document.body || document.documentElement;
+        const walker = document.createTreeWalker(root, NodeFilter.SHOW_ELEMENT, {
+            acceptNode: (n) => INTERACTIVE_TAGS.has(n.tagName) ? NodeFilter.FILTER_ACCEPT : NodeFilter.FILTER_SKIP
+        });
+        const candidates = [];
+        while (walker.nextNode()) candidates.push(walker.currentNode);
+
+        // 2. 只读遍历：样式/几何/文本读取集中在一起，只触发一次布局计算
+        const elements = [];
+        const signatures = [];
+        const matched = [];
+        const inViewport = [];
+        const vw = window.innerWidth, vh = window.innerHeight;
+        for (const el of candidates) {
+            // 先做只读属性的廉价过滤，再做可见性判断
+            if (!isInteractive(el)) continue;
+            if (!isVisible(el)) continue;
+
+            // 每个候选只读一次几何信息：同时用于零尺寸过滤、签名和视口排序
+            const bbox = el.getBoundingClientRect();
+            if (bbox.width <= 0 || bbox.height <= 0) continue;
+
+            const tag = el.tagName.toLowerCase();
+            const label = getLabel(el);
+            const disabled = el.disabled || el.getAttribute('aria-disabled') === 'true';
+
+            matched.push(el);
+            elements.push({
+                id: 0,
+                tag,
+                role: el.getAttribute('role'),
+                label,
+                name: el.getAttribute('name') || el.id || null,
+                input_type: el.getAttribute('type') || null,
+                disabled,
+                bbox: [bbox.x, bbox.y, bbox.width, bbox.height],
+                context: getContext(el)
+            });
+            signatures.push([tag, label, Math.round(bbox.x), Math.round(bbox.y), disabled].join('|'));
+            inViewport.push(bbox.bottom > 0 && bbox.top < vh && bbox.right > 0 && bbox.left < vw);
+        }
+
+        // 3. 分配 ID：仍在页面上的元素沿用已有 ID，新元素分配新 ID。
+        //    只改页面内的表、不改 DOM，不会触发页面自身的 MutationObserver。
+        //    计数器在页面内递增，被取消的推测扫描分配过的 ID 也不会重复
+        if (registry.next < startId) registry.next = startId;
+        matched.forEach((el, i) => {
+            let id = registry.byEl.get(el);
+            if (id === undefined) {
+                id = ++registry.next;
+                registry.byEl.set(el, id);
+                registry.byId.set(id, new WeakRef(el));
+            }
+            elements[i].id = id;
+        });
+        // 清理已被回收的元素留下的反查项
+        if (registry.byId.size > 2 * matched.length + 100) {
+            for (const [id, ref] of registry.byId) {
+                if (!ref.deref()) registry.byId.delete(id);
+            }
+        }
+
+        // 4. 视口内的元素排在前面（各自保持文档顺序），截断摘要时优先保留
+        const order = [...elements.keys()].sort((a, b) => inViewport[b] - inViewport[a] || a - b);
+        return {
+            elements: order.map(i => elements[i]),
+            signatures: order.map(i => signatures[i]),
+            viewportCount: inViewport.filter(Boolean).length,
+            lastId: registry.next
+        };
+    };
+
+    // 页面自上次扫描以来是否可能有变化：DOM/属性变动、输入、滚动、尺寸/焦点/悬停变化、图片与字体加载都会置位。
+    // 没有变化时直接返回上次的扫描结果，稳定页面上每步感知的成本接近 O(1)。
+    // 脚本直接给 .value 赋值、纯布局变化等不产生任何事件，因此缓存结果最多复用 MAX_REUSE_MS。
+    const MAX_REUSE_MS = 1000;
+    let dirty = true;
+    let lastResult = null;
+    let lastScanAt = 0;
+    const markDirty = () => { dirty = true; };
+    // 不设 attributeFilter：祖先上的 aria-expanded、data-*、inert 等任意属性都可能通过选择器改变可见性
+    new MutationObserver(markDirty).observe(document, {
+        childList: true, subtree: true, characterData: true, attributes: true
+    });
+    for (const type of ['input', 'change', 'scroll', 'resize', 'focusin', 'pointerover', 'transitionend', 'animationend']) {
+        window.addEventListener(type, markDirty, { capture: true, passive: true });
+    }
+    // 图片等资源的 load 事件不冒泡到 window，只能在 document 上以捕获方式监听
+    document.addEventListener('load', markDirty, { capture: true, passive: true });
+    document.fonts?.addEventListener('loadingdone', markDirty);
+    const scanIfDirty = (startId) => {
+        const now = performance.now();
+        if (!dirty && lastResult && lastResult.lastId === startId && now - lastScanAt < MAX_REUSE_MS) return lastResult;
+        dirty = false;
+        lastScanAt = now;
+        lastResult = scan(startId);
+        return lastResult;
+    };
+
+    // 提交表单的控件（提交按钮、图片按钮）与链接一样大概率触发跳转
+    const submitsForm = (el) => !!el && !!el.form && (el.type === 'submit' || el.type === 'image');
+
+    window.__agent_extract = (startId, pending) => {
+        if (!pending) return scanIfDirty(startId);
+
+        // 会跳转的点击不走合并路径：新文档提交前旧页面可能先静默 quietMs，提取到的是跳转前的页面
+        if (pending.action === 'click' && submitsForm(registry.byId.get(pending.id)?.deref())) {
+            return { actionStatus: 'navigates' };
+        }
+
+        const status = window.__agent_exec
+            ? window.__agent_exec(pending.id, pending.action, pending.value)
+            : 'fallback';
+        if (status !== 'ok') return { actionStatus: status };
+
+        // DOM 连续 quietMs 没有变化（或到达 settleMs 上限）即认为页面已稳定
+        return new Promise((resolve) => {
+            let finished = false;
+            let quiet = null;
+            const finish = (navigated) => {
+                if (finished) return;
+                finished = true;
+                observer.disconnect();
+                clearTimeout(quiet);
+                clearTimeout(cap);
+                window.removeEventListener('beforeunload', onLeave);
+                window.removeEventListener('pagehide', onLeave);
+                // 动作引发了跳转（如脚本改写 location）：旧文档的元素没有意义，交给调用方重新感知
+                resolve(navigated === true
+                    ? { actionStatus: 'ok', navigated: true }
+                    : { actionStatus: 'ok', ...scanIfDirty(startId) });
+            };
+            const onLeave = () => finish(true);
+            window.addEventListener('beforeunload', onLeave);
+            window.addEventListener('pagehide', onLeave);
+            const observer = new MutationObserver(() => {
+                clearTimeout(quiet);
+                quiet = setTimeout(finish, pending.quietMs);
+            });
+            observer.observe(document, { childList: true, subtree: true, attributes: true, characterData: true });
+            quiet = setTimeout(finish, pending.quietMs);
+            const cap = setTimeout(finish, pending.settleMs);
+        });
+    };
+})();
+"""
+
+# 当前文档没有运行过 init script（如 page.set_content、安装前已打开的文档）时返回 null，由调用方补注入
+_EXTRACT_CALL = "([startId, pending]) => window.__agent_extract ? window.__agent_extract(startId, pending) : null"
+
+# 摘要行格式 id|类型|文本|D|上下文 中的类型缩写（图例写在 Planner 的系统提示词里）
+TAG_ABBR = {"button": "b", "input": "i", "a": "a", "select": "s", "textarea": "t"}
+# 摘要以 "|" 分隔字段、以换行分隔元素，页面文本中的这两类字符需替换掉
+_FIELD_ESCAPE = str.maketrans({"|": "¦", "\n": " ", "\r": " "})
+
+
 class Perception:
     """
     感知模块：提取可见且可交互的元素，增强语义信息。
     对标 browser-use 的 DOM 提取能力。
     """
     
-    def __init__(self):
+    def __init__(self, max_summary_elements: int = 80, max_label_len: int = 60, max_diff_ratio: float = 0.5):
         self.last_element_id = 0
+        # 摘要中最多列出的元素数与 label 长度上限（元素列表本身不截断，供执行使用）
+        self.max_summary_elements = max_summary_elements
+        self.max_label_len = max_label_len
+        # 变化（新增/变化/消失）的元素超过这个比例时，增量摘要不比完整列表省，直接输出完整列表
+        self.max_diff_ratio = max_diff_ratio
+        # 上一次提取的 {元素 ID: 签名} 与 URL，用于生成增量摘要
+        self._prev_sigs: Dict[int, str] = {}
+        self._prev_url: Optional[str] = None
+        # 最近一次生成的摘要是否为增量（False 表示完整列表）
+        self.summary_is_diff = False
+        # 最近一次提取的页面状态指纹（URL + 全部元素签名），与摘要是否为增量无关
+        self.fingerprint: Optional[str] = None
     
-    async def extract_elements(self, page: Page) -> Tuple[List[ElementSnapshot], str]:
+    def reset(self):
+        """重置元素编号与增量基线（新任务开始时调用），保证相同页面得到相同的 DOM 摘要"""
+        self.last_element_id = 0
+        self._prev_sigs = {}
+        self._prev_url = None
+        self.summary_is_diff = False
+        self.fingerprint = None
+    
+    async def install(self, page: Page):
+        """在页面上注册提取脚本：对之后加载的文档生效，并立即注入当前文档"""
+        await page.add_init_script(script=PERCEPTION_JS)
+        await page.evaluate(PERCEPTION_JS)
+    
+    async def extract_elements(self, page: Page) -> Tuple[List[ElementSnapshot], str, Dict[int, ElementSnapshot]]:
         """
-        从页面提取可交互元素，返回元素列表 + 文本摘要。
+        从页面提取可交互元素，返回元素列表 + 文本摘要 + 按 ID 索引的元素字典。
         
         增强点：
         - 更丰富的 label（aria/title/alt 聚合）
@@ -24,105 +277,106 @@ class Perception:
         - disabled 状态
         - bbox（几何）
         - 上下文（最近 form、fieldset、父文本）
+        - 稳定 ID：仍在页面上的元素沿用上一步的 ID（记在页面内的 WeakMap 中，不修改 DOM）
+        - 增量摘要：同一 URL 下只列出新增/变化的元素，未变化的折叠为一行；
+          URL 变化或变化的元素超过 max_diff_ratio 时输出完整列表
+        - 视口优先：视口内元素排在前面，摘要最多列出 max_summary_elements 个，其余只给出数量
         """
-        js_code = """
-        (startId) => {
-            const isVisible = (el) => {
-                if (!el) return false;
-                const style = window.getComputedStyle(el);
-                const rect = el.getBoundingClientRect();
-                if (style.display === 'none') return false;
-                if (style.visibility === 'hidden') return false;
-                if (parseFloat(style.opacity) === 0) return false;
-                if (rect.width <= 0 || rect.height <= 0) return false;
-                return true;
-            };
-
-            const isInteractive = (el) => {
-                if (el.tagName === 'INPUT') {
-                    const type = (el.getAttribute('type') || '').toLowerCase();
-                    if (type === 'hidden') return false;
-                }
-                if (el.tagName === 'A') {
-                    const href = el.getAttribute('href');
-                    const role = el.getAttribute('role');
-                    return href || role === 'button';
-                }
-                return true;
-            };
-
-            // 聚合 label 的逻辑
-            const getLabel = (el) => {
-                const candidates = [
-                    (el.innerText || '').trim(),
-                    (el.value || '').trim(),
-                    el.getAttribute('placeholder') || '',
-                    el.getAttribute('aria-label') || '',
-                    el.getAttribute('title') || '',
-                    el.getAttribute('alt') || '',
-                    el.getAttribute('name') || '',
-                ];
-                const chosen = candidates.find(c => c.length > 0);
-                return chosen || '(无文本)';
-            };
-
-            // 获取上下文（最近的 form/fieldset 以及父元素文本）
-            const getContext = (el) => {
-                let form = el.closest('form');
-                let fieldset = el.closest('fieldset');
-                let legend = fieldset?.querySelector('legend');
-                let parentText = (el.parentElement?.innerText || '').trim().split('\\n')[0];
-                
-                let parts = [];
-                if (legend) parts.push('legend: ' + legend.innerText.trim());
-                if (form?.id) parts.push('form: ' + form.id);
-                if (parentText && parentText !== getLabel(el)) parts.push('parent: ' + parentText.slice(0, 30));
-                
-                return parts.length > 0 ? parts.join(' | ') : null;
-            };
-
-            const elements = [];
-            let currentId = startId;
-            const nodes = document.querySelectorAll('button, a, input, textarea, select');
-            
-            for (const el of nodes) {
-                if (!isVisible(el)) continue;
-                if (!isInteractive(el)) continue;
-
-                currentId += 1;
-                el.setAttribute('data-agent-id', String(currentId));
-
-                const tag = el.tagName.toLowerCase();
-                const role = el.getAttribute('role');
-                const label = getLabel(el);
-                const name = el.getAttribute('name') || el.id || null;
-                const inputType = el.getAttribute('type') || null;
-                const disabled = el.disabled || el.getAttribute('aria-disabled') === 'true';
-                const bbox = el.getBoundingClientRect();
-                const context = getContext(el);
-
-                elements.push({
-                    id: currentId,
-                    tag,
-                    role,
-                    label,
-                    name,
-                    input_type: inputType,
-                    disabled,
-                    bbox: { x: bbox.x, y: bbox.y, width: bbox.width, height: bbox.height },
-                    context
-                });
-            }
-
-            return { elements, lastId: currentId };
-        }
+        result = await self._call(page, None)
+        return self._process(result, page.url)
+    
+    async def rescan(self, page: Page) -> Dict[int, ElementSnapshot]:
         """
-        
-        result = await page.evaluate(js_code, self.last_element_id)
+        只提取元素、不生成摘要也不更新增量基线，返回按 ID 索引的元素字典。
+        用于等待 LLM 期间推测性地刷新页面状态：结果不会交给 LLM，因此不能影响下一次增量摘要。
+        """
+        result = await self._call(page, None)
+        self.last_element_id = max(self.last_element_id, result["lastId"])
+        return {s.id: s for s in self._snapshots(result)}
+    
+    async def act_and_extract(
+        self,
+        page: Page,
+        action: str,
+        element_id: int,
+        value: Optional[str],
+        settle_ms: float,
+        quiet_ms: float = 100,
+    ) -> Tuple[str, Optional[Tuple[List[ElementSnapshot], str, Dict[int, ElementSnapshot]]]]:
+        """
+        一次 page.evaluate 内执行 click/fill、等待 DOM 静默（最多 settle_ms）并提取元素。
+        返回 (动作状态, 提取结果)；动作未成功或页面开始跳转时不做提取，结果为 None。
+        点击提交表单的控件时不执行动作，返回状态 navigates，由调用方按跳转处理。
+        """
+        pending = {"action": action, "id": element_id, "value": value, "settleMs": settle_ms, "quietMs": quiet_ms}
+        result = await self._call(page, pending)
+        status = result["actionStatus"]
+        if status != "ok" or result.get("navigated"):
+            return status, None
+        return status, self._process(result, page.url)
+    
+    async def _call(self, page: Page, pending: Optional[dict]) -> dict:
+        """
+        按名字调用已注册的提取函数；当前文档缺少该函数时补注入一次再调用。
+        纯提取时若页面在提取过程中跳转（执行上下文被销毁），等新文档 DOM 就绪后重试一次；
+        带动作的调用不重试（动作可能已生效），由调用方处理。
+        """
+        try:
+            result = await page.evaluate(_EXTRACT_CALL, [self.last_element_id, pending])
+        except Exception as e:
+            if pending is not None or "Execution context was destroyed" not in str(e):
+                raise
+            await page.wait_for_load_state("domcontentloaded")
+            result = await page.evaluate(_EXTRACT_CALL, [self.last_element_id, pending])
+        if result is None:
+            await page.evaluate(PERCEPTION_JS)
+            result = await page.evaluate(_EXTRACT_CALL, [self.last_element_id, pending])
+        return result
+    
+    def invalidate(self):
+        """丢弃增量基线，下一次提取输出完整列表（例如基线对应的摘要没有交给 LLM 时）"""
+        self._prev_sigs = {}
+    
+    def _process(self, result: dict, url: str) -> Tuple[List[ElementSnapshot], str, Dict[int, ElementSnapshot]]:
+        """把页面返回的原始结果转换为 元素列表 + 摘要 + 索引，并更新增量基线"""
         self.last_element_id = result["lastId"]
+        snapshots = self._snapshots(result)
         
-        # 转换为 ElementSnapshot 对象
-        snapshots = [
+        # 生成文本摘要（用于 LLM）：只覆盖前 max_summary_elements 个元素，增量基线也只记录这些；
+        # 是否“消失”则对照页面上的全部元素判断，被挤出列表的元素不算消失
+        listed = snapshots[:self.max_summary_elements]
+        sigs = dict(zip((s.id for s in listed), result["signatures"]))
+        present = {s.id for s in snapshots}
+        if url != self._prev_url or not self._prev_sigs or self._diff_ratio(sigs, present) > self.max_diff_ratio:
+            summary = self._generate_summary(listed)
+            self.summary_is_diff = False
+        else:
+            summary = self._generate_diff_summary(listed, sigs, present)
+            self.summary_is_diff = True
+        hidden = len(snapshots) - len(listed)
+        if hidden:
+            if len(listed) >= result["viewportCount"]:
+                summary += f"\n[+{hidden} more off-screen elements; scroll to reveal]"
+            else:
+                summary += f"\n[+{hidden} more elements not listed]"
+        self._prev_sigs = sigs
+        self._prev_url = url
+        self.fingerprint = hashlib.blake2b("\n".join([url, *result["signatures"]]).encode(), digest_size=16).hexdigest()
+        snapshots_by_id = {s.id: s for s in snapshots}
+        
+        return snapshots, summary, snapshots_by_id
+    
+    def _diff_ratio(self, sigs: Dict[int, str], present: Set[int]) -> float:
+        """相对上一步基线，新增/变化/消失的元素占两步元素并集的比例"""
+        changed = sum(1 for eid, sig in sigs.items() if self._prev_sigs.get(eid) != sig)
+        removed = sum(1 for eid in self._prev_sigs if eid not in present)
+        total = len(sigs) + removed
+        return (changed + removed) / total if total else 0.0
+    
+    @staticmethod
+    def _snapshots(result: dict) -> List[ElementSnapshot]:
+        """把页面返回的原始元素转换为 ElementSnapshot 对象"""
+        return [
             ElementSnapshot(
                 id=item["id"],
                 tag=item["tag"],
@@ -131,22 +385,58 @@ class Perception:
                 name=item["name"],
                 input_type=item["input_type"],
                 disabled=item["disabled"],
-                bbox=item["bbox"],
+                bbox=tuple(item["bbox"]),
                 context=item["context"]
             )
             for item in result["elements"]
         ]
-        
-        # 生成文本摘要（用于 LLM）
-        summary = self._generate_summary(snapshots)
-        
-        return snapshots, summary
     
     def _generate_summary(self, snapshots: List[ElementSnapshot]) -> str:
         """生成 DOM 文本摘要，给 LLM 看"""
+        # 完整列表可能有上百行：格式直接写在生成器表达式里，不逐行调用方法；
+        # 行格式与 _format_line（增量摘要使用）相同，修改时两处需保持一致
+        clip = self._clip
+        return "\n".join(
+            f"{s.id}|{TAG_ABBR.get(s.tag, s.tag)}|{clip(s.label).translate(_FIELD_ESCAPE)}"
+            f"|{'D' if s.disabled else ''}|{(s.context or '').translate(_FIELD_ESCAPE)}"
+            for s in snapshots
+        )
+    
+    def _generate_diff_summary(self, snapshots: List[ElementSnapshot], sigs: Dict[int, str], present: Set[int]) -> str:
+        """
+        生成相对上一步的增量摘要：新增元素以 "+ " 开头，变化元素以 "~ " 开头，
+        连续未变化的元素折叠为 "[N unchanged elements #a..#b]"，
+        已不在页面上（present 之外）的元素汇总为 "[removed ...]"。
+        """
         lines = []
+        unchanged: List[int] = []
+        
+        def flush():
+            if unchanged:
+                lines.append(f"[{len(unchanged)} unchanged elements #{unchanged[0]}..#{unchanged[-1]}]")
+                unchanged.clear()
+        
         for snap in snapshots:
-            context_str = f" ({snap.context})" if snap.context else ""
-            disabled_str = " [DISABLED]" if snap.disabled else ""
-            lines.append(f"[{snap.id}] {snap.tag}: \"{snap.label}\"{disabled_str}{context_str}")
+            prev = self._prev_sigs.get(snap.id)
+            if prev == sigs[snap.id]:
+                unchanged.append(snap.id)
+                continue
+            flush()
+            marker = "+ " if prev is None else "~ "
+            lines.append(marker + self._format_line(snap))
+        flush()
+        
+        removed = [eid for eid in self._prev_sigs if eid not in present]
+        if removed:
+            lines.append("[removed " + ", ".join(f"#{eid}" for eid in removed) + "]")
         return "\n".join(lines)
+    
+    def _clip(self, label: str) -> str:
+        return label if len(label) <= self.max_label_len else label[:self.max_label_len] + "…"
+    
+    def _format_line(self, snap: ElementSnapshot) -> str:
+        """摘要中的一行：id|标签|文本|D(禁用)|上下文；文本与上下文中的分隔符和换行会被替换（与 _generate_summary 一致）"""
+        tag = TAG_ABBR.get(snap.tag, snap.tag)
+        label = self._clip(snap.label).translate(_FIELD_ESCAPE)
+        context = (snap.context or "").translate(_FIELD_ESCAPE)
+        return f"{snap.id}|{tag}|{label}|{'D' if snap.disabled else ''}|{context}"
@@ -0,0 +1,104 @@
+"""计划缓存模块：复用已成功任务的动作序列（Agentic Plan Caching）"""
+
+import hashlib
+import re
+from typing import Dict, List, Optional, Set, Tuple
+from .models import PlannerOutput
+
+try:
+    import jieba
+except ImportError:  # 可选依赖：pip install jieba，未安装时中文按二元组切分
+    jieba = None
+
+
+# 中英文常见虚词，分词之后再剔除
+_STOPWORDS = {
+    "the", "a", "an", "and", "or", "to", "of", "in", "on", "at", "for", "with", "please",
+    "在", "的", "了", "并", "和", "与", "把", "将", "请", "一下", "然后", "页面", "上",
+}
+# 拉丁字母/数字组成的词，或连续的汉字
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_]+|[\u4e00-\u9fff]+")
+_CJK_RE = re.compile(r"[\u4e00-\u9fff]")
+# 二元组切分前先在多字虚词处断开；单字虚词（“上”“在”“和”等）常是实词的一部分（上海、在线），不作断点，
+# 只在分词后整词剔除
+_CJK_STOP_RE = re.compile("|".join(
+    sorted((w for w in _STOPWORDS if len(w) > 1 and _CJK_RE.match(w)), key=len, reverse=True)
+))
+
+PlanKey = Tuple[Tuple[str, ...], str]
+# 缓存中的一步：决策 + 目标元素的 (标签, 文本)，重放前用于核对页面上同一 ID 是否仍是同一个元素
+PlanTarget = Optional[Tuple[str, str]]
+PlanStep = Tuple[PlannerOutput, PlanTarget]
+
+
+def _cjk_tokens(run: str) -> List[str]:
+    """切分一段连续汉字：装了 jieba 用 jieba 分词，否则在虚词处断开后取二元组"""
+    if jieba is not None:
+        return jieba.lcut(run)
+    tokens = []
+    for segment in _CJK_STOP_RE.split(run):
+        if len(segment) == 1:
+            tokens.append(segment)
+        tokens.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+    return tokens
+
+
+def extract_keywords(instruction: str) -> Tuple[str, ...]:
+    """提取指令关键词（分词、去停用词、去重、排序），对语序和标点不敏感"""
+    words: Set[str] = set()
+    for token in _TOKEN_RE.findall(instruction):
+        if _CJK_RE.match(token):
+            words.update(_cjk_tokens(token))
+        else:
+            words.add(token.lower())
+    return tuple(sorted(words - _STOPWORDS))
+
+
+def dom_fingerprint(dom_summary: str) -> str:
+    """DOM 摘要指纹"""
+    return hashlib.blake2b(dom_summary.encode(), digest_size=8).hexdigest()
+
+
+def _similarity(a: Tuple[str, ...], b: Tuple[str, ...]) -> float:
+    """关键词集合的 Jaccard 相似度"""
+    sa, sb = set(a), set(b)
+    return len(sa & sb) / len(sa | sb) if sa or sb else 1.0
+
+
+class PlanCache:
+    """
+    计划缓存：以 (指令关键词, 起始页 DOM 指纹) 为键，保存成功任务的完整决策序列。
+    查询时起始页指纹必须一致，关键词完全相同优先；allow_similar 时退而取相似度不低于 min_similarity 的最相近一条
+    （缓存的 fill 取值属于另一条指令，需要由 Planner 的 adapt_model 改写）。命中后由 Planner 逐步重放，省去 LLM 调用。
+    """
+    
+    def __init__(self, min_similarity: float = 0.6):
+        self.min_similarity = min_similarity
+        # DOM 指纹 → {关键词: (原始指令, 决策序列)}
+        self._plans: Dict[str, Dict[Tuple[str, ...], Tuple[str, List[PlanStep]]]] = {}
+    
+    @staticmethod
+    def key(instruction: str, dom_summary: str) -> PlanKey:
+        return extract_keywords(instruction), dom_fingerprint(dom_summary)
+    
+    def get(self, key: PlanKey, allow_similar: bool = True) -> Optional[Tuple[str, List[PlanStep]]]:
+        """返回 (原始指令, 决策序列)，未命中返回 None；allow_similar=False 时只接受关键词完全相同的计划"""
+        keywords, fingerprint = key
+        bucket = self._plans.get(fingerprint)
+        if not bucket:
+            return None
+        if keywords in bucket:
+            return bucket[keywords]
+        if not allow_similar:
+            return None
+        best = max(bucket, key=lambda k: _similarity(k, keywords))
+        return bucket[best] if _similarity(best, keywords) >= self.min_similarity else None
+    
+    def put(self, key: PlanKey, instruction: str, plan: List[PlanStep]):
+        """保存一条以 done 结尾的决策序列"""
+        if plan and plan[-1][0].action == "done":
+            keywords, fingerprint = key
+            self._plans.setdefault(fingerprint, {})[keywords] = (instruction, list(plan))
+    
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self._plans.values())
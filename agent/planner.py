@@ -1,67 +1,401 @@
 """规划模块：调用 LLM 决策下一步"""
 
+import asyncio
+import hashlib
 import json
+import ssl
+from dataclasses import asdict, replace
+from typing import Any, Awaitable, Callable, Dict, Optional
+import certifi
+import httpx
+import openai
 from openai import AsyncOpenAI
-from .models import PlannerOutput
+from ._retry import backoff_delay
+from .models import ACTIONS, ElementSnapshot, PlannerOutput
 from .memory import Memory
+from .plan_cache import PlanCache, PlanTarget
+
+try:
+    import orjson
+except ImportError:  # 可选依赖：pip install orjson
+    orjson = None
+
+
+# 系统提示词在所有步骤间保持不变，放在消息最前面，便于服务端做前缀缓存（prompt caching）。
+# 任何动态内容（指令、DOM 摘要、历史）都只能放进 user 消息，不能拼进这里。
+# JSON 格式放在最前；字段顺序 thought → action/element_id/value → plan 与流式提前结束配合，不要调整。
+_RULES = (
+    "目标已达成时 action=done，element_id 与 value 为 null。\n"
+    "你是 Web UI 自动化智能体，按用户指令和可交互元素列表决定下一步，不要重复历史步骤中的操作。\n"
+    "元素行 id|类型|文本|D|上下文：b=button i=input a=链接 s=select t=textarea，D=禁用。\n"
+    "增量列表：'+' 新增，'~' 变化，'[N unchanged elements #a..#b]' 未变，'[removed ...]' 已消失。"
+)
+_SYSTEM_PROMPT = (
+    "只输出 JSON：{\"thought\":\"页面状态与选择理由\",\"action\":\"click|fill|press|scroll|wait|back|done\","
+    "\"element_id\":1,\"value\":\"fill 内容/press 按键/scroll 方向/wait 毫秒，否则 null\",\"plan\":[\"后续步骤\"]}\n"
+    + _RULES
+)
+
+# 结构化输出（response_format=json_schema）下由服务端约束格式，系统提示词不再复述 schema。
+# 属性顺序与 _SYSTEM_PROMPT 中的 JSON 一致
+_DECISION_SCHEMA = {
+    "name": "planner_decision",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "thought": {"type": "string"},
+            "action": {"type": "string", "enum": list(ACTIONS)},
+            "element_id": {"type": ["integer", "null"]},
+            "value": {"type": ["string", "null"], "description": "fill 内容/press 按键/scroll 方向/wait 毫秒"},
+            "plan": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["thought", "action", "element_id", "value", "plan"],
+        "additionalProperties": False,
+    },
+}
+
+# 完整的完成判断规则只在上一步失败后附在 user 消息里，正常步骤不付这部分 token
+_RETRY_GUIDELINE = (
+    "上一步失败。先判断用户目标是否其实已经达成（出现预期结果、已提交等），是则立即 action=done；"
+    "否则换一个元素或动作，不要重复失败的操作。"
+)
+
+_ADAPT_PROMPT = (
+    "一条历史任务的输入框取值需要迁移到新任务。\n"
+    "历史指令：{old}\n新指令：{new}\n历史取值：{value}\n"
+    "只输出 JSON：{{\"value\": \"新任务应输入的内容\"}}"
+)
+
+# 创建 SSL 上下文（加载 CA 证书）是构造 HTTP 客户端的主要开销，进程内只做一次
+_SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+
+def create_client(
+    api_key: Optional[str] = None,
+    base_url: Optional[str] = None,
+    max_connections: int = 64,
+    max_keepalive_connections: int = 32,
+) -> AsyncOpenAI:
+    """
+    创建复用连接的 AsyncOpenAI 客户端：HTTP/2 多路复用 + 保持连接池 + 共享的 SSL 上下文，
+    多标签页并发与流式请求共用已建立的 TCP/TLS 连接，避免每次请求重新握手。
+    未安装 h2（pip install httpx[http2]）时退回 HTTP/1.1 连接池。
+    SDK 自带的重试关闭，由 Planner 统一重试（流式输出中途断开也能重试）。
+    """
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=60,
+    )
+    timeout = httpx.Timeout(60.0, connect=5.0)
+    try:
+        http_client = httpx.AsyncClient(verify=_SSL_CONTEXT, http2=True, limits=limits, timeout=timeout)
+    except ImportError:
+        http_client = httpx.AsyncClient(verify=_SSL_CONTEXT, limits=limits, timeout=timeout)
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+
+def _loads(text: str) -> Any:
+    """解析 JSON：已安装 orjson 时优先使用，解析失败再交给标准库（兼容超长整数等边界情况）"""
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+
+# 可重试的 LLM 错误：限流、超时、连接/流中断、服务端 5xx；鉴权、参数错误等直接抛出
+_RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # 含 APITimeoutError
+    openai.InternalServerError,
+    httpx.TransportError,  # 流式读取中途断开时 SDK 不做包装
+)
+
+
+# 页面状态不变时可直接复用的决策：只限不改变页面数据的动作。
+# click/fill 等动作执行成功后页面往往没有变化，复用只会把“提交”“加入购物车”重复执行，
+# 模型也看不到上一步已成功的历史记录，无法及时给出 done
+_REUSABLE_ACTIONS = frozenset({"wait", "scroll"})
+
+
+# 流式输出中这些字段就绪后即可开始准备动作
+_ACTION_FIELDS = ("action", "element_id")
+# 这些字段全部就绪后决策已可执行，剩余输出（plan）可以不等
+_DECISION_FIELDS = ("action", "element_id", "value")
+
+
+class _JSONFieldStream:
+    """
+    增量扫描流式输出的 JSON 对象：顶层字段的值一闭合就解析出来放进 fields，
+    无需等到整个对象输出完毕。
+    """
+    
+    def __init__(self):
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._key_start: Optional[int] = None
+        self._key: Optional[str] = None
+        self._value_start: Optional[int] = None
+    
+    def feed(self, chunk: str):
+        self.buffer += chunk
+        buf = self.buffer
+        for i in range(self._pos, len(buf)):
+            ch = buf[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = _loads(buf[self._key_start:i + 1])
+                        self._key_start = None
+                continue
+            
+            if ch == '"':
+                self._in_string = True
+                if self._depth == 1 and self._key is None:
+                    self._key_start = i
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                if self._depth == 1:
+                    self._close_value(i)
+                self._depth -= 1
+            elif self._depth == 1:
+                if ch == ":" and self._key is not None:
+                    self._value_start = i + 1
+                elif ch == ",":
+                    self._close_value(i)
+        self._pos = len(buf)
+    
+    def _close_value(self, end: int):
+        if self._key is not None and self._value_start is not None:
+            try:
+                self.fields[self._key] = _loads(self.buffer[self._value_start:end])
+            except json.JSONDecodeError:
+                pass
+        self._key = None
+        self._value_start = None
 
 
 class Planner:
     """规划模块：调用 LLM 决策下一步"""
     
-    def __init__(self, client: AsyncOpenAI, model: str):
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        model: str,
+        prompt_cache_key: Optional[str] = "planner_v2",
+        plan_cache: Optional[PlanCache] = None,
+        adapt_model: Optional[str] = None,
+        stream: bool = True,
+        early_exit: bool = True,
+        max_decision_hits: int = 2,
+        max_attempts: int = 3,
+        retry_base: float = 0.25,
+        structured_output: bool = False,
+    ):
         self.client = client
         self.model = model
+        # 流式输出：动作字段一到就回调 on_action，执行端可提前准备
+        self.stream = stream
+        # 流式模式下决策字段一齐全就结束读取并关闭流，不等模型输出剩余的 plan
+        self.early_exit = early_exit
+        # 显式前缀缓存的路由键（OpenAI prompt_cache_key）；DeepSeek/Qwen 等自动前缀缓存的服务会忽略它。
+        # 设为 None 则不发送该字段。
+        self.prompt_cache_key = prompt_cache_key
+        self.plan_cache = plan_cache
+        # 重放 fill 时用于改写 value 的小模型（如 gpt-4o-mini / qwen-turbo），None 则原样重放
+        self.adapt_model = adapt_model
+        # 同一页面状态下最多连续复用几次旧决策
+        self.max_decision_hits = max_decision_hits
+        # 可重试错误最多尝试 max_attempts 次，第 n 次重试前等待 retry_base * 2^n 秒（带随机抖动）
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        # 服务端支持 response_format=json_schema 时开启：格式由服务端约束，系统提示词省去 schema 描述
+        self.structured_output = structured_output
     
-    async def decide(self, instruction: str, dom_summary: str, memory: Memory) -> PlannerOutput:
+    async def decide(
+        self,
+        instruction: str,
+        dom_summary: str,
+        memory: Memory,
+        on_action: Optional[Callable[[Dict[str, Any]], None]] = None,
+        page_state: Optional[str] = None,
+        snapshots_by_id: Optional[Dict[int, ElementSnapshot]] = None,
+    ) -> PlannerOutput:
         """
         根据指令 + DOM 摘要 + 内存，输出决策。
+        
+        消息依次为 system、自最近一次完整 DOM 列表以来的对话轮次（memory.dialogue）、本轮 user。
+        指令只出现在对话第一轮，之前的轮次逐步追加而不改写，
+        因此 system + 历史轮次构成跨步骤稳定的前缀，便于服务端前缀缓存。
+        
+        若计划缓存命中，直接重放缓存的决策，不调用 LLM。重放前用 snapshots_by_id 核对目标元素：
+        同一 ID 在当前页面上的 (标签, 文本) 与录制时不同（ID 编号随扫描时机变化），则放弃剩余缓存计划，改问 LLM。
+        
+        页面状态（page_state，通常为 Perception.fingerprint；省略时用 dom_summary）与之前某步相同、
+        且该步决策为 wait/scroll（_REUSABLE_ACTIONS）时直接复用，例如页面仍在加载时的等待；
+        连续复用 max_decision_hits 次后重新询问 LLM；上一步失败时不复用（失败的决策在同一页面上只会再失败），
+        而是带上 _RETRY_GUIDELINE 重新询问。
+        
+        流式模式下，action / element_id 一闭合就以已解析字段的 dict 调用 on_action，
+        此时 plan 等字段可能仍在输出（schema 中 plan 排在动作字段之后）。
+        开启 early_exit 时 value 闭合后即停止接收，plan 可能为空。
         """
-        system_prompt = (
-            "你是一个 Web UI 自动化智能体。\n"
-            "你将根据用户指令和 DOM 交互元素列表做出下一步操作。\n"
-            "【极其重要的规则】：\n"
-            "1. 如果你观察当前页面，发现用户的目标已经达成（出现预期结果、已提交等），立即设置 action='done'。\n"
-            "2. 不要重复执行相同操作。参考 Memory 中的历史步骤。\n"
-            "你必须且只能输出 JSON 字符串，格式如下：\n"
-            "{\n"
-            "  \"thought\": \"分析当前页面状态，判断任务进度，说明为什么选择此 action\",\n"
-            "  \"plan\": [\"step1_desc\", \"step2_desc\"],\n"
-            "  \"action\": \"click|fill|press|scroll|wait|back|done\",\n"
-            "  \"element_id\": 1,\n"
-            "  \"value\": \"要输入的内容（仅 fill 时需要）\"\n"
-            "}\n"
-            "如果 action 是 done，element_id 和 value 必须为 null。"
-        )
+        # 只有完整元素列表（对话的第一轮）才能作为缓存键，增量摘要在不同页面间可能相同
+        if not memory.pending_plan and not memory.dialogue and self.plan_cache is not None:
+            # 相似指令的计划里 fill 的取值属于原指令，没有 adapt_model 改写时只接受完全匹配
+            hit = self.plan_cache.get(
+                self.plan_cache.key(instruction, dom_summary), allow_similar=self.adapt_model is not None
+            )
+            if hit:
+                cached_instruction, plan = hit
+                print(f"✓ 命中计划缓存（{len(plan)} 步）")
+                if self.adapt_model and cached_instruction != instruction:
+                    plan = [(await self._adapt_fill(d, cached_instruction, instruction), t) for d, t in plan]
+                memory.pending_plan.extend(plan)
         
         memory_str = memory.format_history()
+        last_failed = bool(memory.history) and not memory.history[-1].result
+        # 对话的第一轮携带指令和完整元素列表，后续轮次只需增量
         user_prompt = (
-            f"用户指令：{instruction}\n\n"
-            f"当前可交互元素：\n{dom_summary}\n\n"
+            (f"用户指令：{instruction}\n\n" if not memory.dialogue else "")
+            + f"当前可交互元素：\n{dom_summary}\n\n"
             f"历史步骤：\n{memory_str}\n\n"
-            "请给出下一步操作。"
+            + (f"{_RETRY_GUIDELINE}\n" if last_failed else "")
+            + "请给出下一步操作。"
         )
+        user_message = {"role": "user", "content": user_prompt}
         
+        if memory.pending_plan:
+            decision, target = memory.pending_plan.popleft()
+            if self._target_matches(decision, target, snapshots_by_id):
+                # 重放的步骤也写入对话，使后续增量摘要仍有可对照的上下文
+                replayed = json.dumps(asdict(decision), ensure_ascii=False)
+                memory.dialogue += [user_message, {"role": "assistant", "content": replayed}]
+                return decision
+            print(f"⚠ 缓存计划的目标元素 {decision.element_id} 与当前页面不符，放弃重放")
+            memory.pending_plan.clear()
+        
+        state_key = hashlib.sha1(f"{instruction}\x00{page_state or dom_summary}".encode()).hexdigest()
+        if last_failed:
+            memory.decision_cache.pop(state_key, None)
+        cached = memory.decision_cache.get(state_key)
+        if cached is not None and memory.decision_hits < self.max_decision_hits:
+            memory.decision_hits += 1
+            print(f"✓ 页面状态未变化，复用之前的决策（第 {memory.decision_hits} 次）")
+            reused = json.dumps(asdict(cached), ensure_ascii=False)
+            memory.dialogue += [user_message, {"role": "assistant", "content": reused}]
+            return cached
+        memory.decision_hits = 0
+        
+        system_prompt = _RULES if self.structured_output else _SYSTEM_PROMPT
+        messages = [{"role": "system", "content": system_prompt}, *memory.dialogue, user_message]
+        output_str = await self._with_retry(lambda: self._complete(messages, on_action))
+        memory.dialogue += [user_message, {"role": "assistant", "content": output_str}]
+        try:
+            data = _loads(output_str)
+        except json.JSONDecodeError as e:
+            print(f"JSON 解析失败: {e}, 原始输出: {output_str}")
+            raise
+        decision = PlannerOutput(
+            thought=data.get("thought", ""),
+            plan=data.get("plan", []),
+            action=data.get("action", "done"),
+            element_id=data.get("element_id"),
+            value=data.get("value")
+        )
+        if decision.action in _REUSABLE_ACTIONS:
+            memory.decision_cache[state_key] = decision
+        return decision
+    
+    @staticmethod
+    def _target_matches(
+        decision: PlannerOutput,
+        target: PlanTarget,
+        snapshots_by_id: Optional[Dict[int, ElementSnapshot]],
+    ) -> bool:
+        """缓存决策的目标元素是否仍是录制时的那个（不针对元素的动作、未提供快照时视为匹配）"""
+        if target is None or snapshots_by_id is None:
+            return True
+        snap = snapshots_by_id.get(decision.element_id)
+        return snap is not None and (snap.tag, snap.label) == target
+    
+    async def _complete(self, messages: list, on_action: Optional[Callable[[Dict[str, Any]], None]]) -> str:
+        """
+        调用 LLM 返回输出的 JSON 文本；流式模式下动作字段就绪即回调 on_action。
+        early_exit 时决策字段齐全就关闭流，返回由已解析字段重新序列化的 JSON（thought 在前，通常已包含）。
+        """
+        extra_body = {"prompt_cache_key": self.prompt_cache_key} if self.prompt_cache_key else None
+        if self.structured_output:
+            response_format = {"type": "json_schema", "json_schema": _DECISION_SCHEMA}
+        else:
+            response_format = {"type": "json_object"}
         response = await self.client.chat.completions.create(
             model=self.model,
             temperature=0,
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
+            response_format=response_format,
+            messages=messages,
+            extra_body=extra_body,
+            stream=self.stream,
         )
+        if not self.stream:
+            return response.choices[0].message.content
+        
+        scanner = _JSONFieldStream()
+        notified = on_action is None
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            scanner.feed(chunk.choices[0].delta.content or "")
+            if not notified and all(f in scanner.fields for f in _ACTION_FIELDS):
+                notified = True
+                on_action(dict(scanner.fields))
+            if self.early_exit and all(f in scanner.fields for f in _DECISION_FIELDS):
+                # 关闭连接，服务端随之停止生成
+                await response.close()
+                return json.dumps(scanner.fields, ensure_ascii=False)
+        return scanner.buffer
+    
+    async def _with_retry(self, request: Callable[[], Awaitable[Any]]) -> Any:
+        """执行 LLM 请求，遇到可重试错误时按指数退避 + 抖动重试，其余错误直接抛出"""
+        for attempt in range(self.max_attempts):
+            try:
+                return await request()
+            except _RETRYABLE_ERRORS as e:
+                if attempt == self.max_attempts - 1:
+                    raise
+                delay = backoff_delay(attempt, self.retry_base)
+                print(f"⚠ LLM 请求失败（{type(e).__name__}），{delay:.2f}s 后重试")
+                await asyncio.sleep(delay)
+    
+    async def _adapt_fill(self, decision: PlannerOutput, old_instruction: str, new_instruction: str) -> PlannerOutput:
+        """用小模型把缓存中 fill 的 value 改写为新指令对应的值"""
+        if decision.action != "fill" or not decision.value:
+            return decision
         
-        output_str = response.choices[0].message.content
+        response = await self._with_retry(lambda: self.client.chat.completions.create(
+            model=self.adapt_model,
+            temperature=0,
+            response_format={"type": "json_object"},
+            messages=[{
+                "role": "user",
+                "content": _ADAPT_PROMPT.format(old=old_instruction, new=new_instruction, value=decision.value),
+            }],
+        ))
         try:
-            data = json.loads(output_str)
-            return PlannerOutput(
-                thought=data.get("thought", ""),
-                plan=data.get("plan", []),
-                action=data.get("action", "done"),
-                element_id=data.get("element_id"),
-                value=data.get("value")
-            )
-        except json.JSONDecodeError as e:
-            print(f"JSON 解析失败: {e}, 原始输出: {output_str}")
-            raise
+            value = _loads(response.choices[0].message.content).get("value")
+        except json.JSONDecodeError:
+            return decision
+        return replace(decision, value=value) if value else decision
@@ -1,20 +1,41 @@
 import asyncio
 import os
+import sys
 
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
 
-from agent import WebUIAgent
+from agent import WebUIAgent, create_client
 
 # 加载 .env 文件中的环境变量
 load_dotenv()
-client = AsyncOpenAI(
+client = create_client(
     api_key=os.getenv("OPENAI_API_KEY"),
     base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
 )
 model = "qwen-max"
 
 
+def install_fast_event_loop():
+    """非 Windows 平台且已安装 uvloop（可选依赖）时，用 uvloop 替换默认事件循环"""
+    if sys.platform == "win32":
+        return
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+async def main(instruction: str, start_url: str, max_steps: int = 20):
+    # Python 3.12+：新任务立即同步执行到第一个 await，已就绪的协程无需经过调度器
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    
+    # 浏览器在 async with 内只启动一次，追加的 run() 复用同一个 Chromium 进程
+    async with WebUIAgent(client, model) as agent:
+        await agent.run(instruction, start_url, max_steps=max_steps)
+
+
 # ============== 主函数 ==============
 
 if __name__ == "__main__":
@@ -23,6 +44,5 @@ if __name__ == "__main__":
     start_url = "https://www.baidu.com"
     
     # 创建 Agent 实例并运行
-    agent = WebUIAgent(client, model)
-    asyncio.run(agent.run(user_instruction, start_url, max_steps=20))
-
+    install_fast_event_loop()
+    asyncio.run(main(user_instruction, start_url, max_steps=20))